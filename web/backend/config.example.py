@@ -11,11 +11,13 @@ Then edit config.py to match your server's resources.
 # ---------------------------
 
 # Maximum allowed distance for map generation (meters)
-# Adjust based on your server's RAM:
-#   - 4GB RAM: MAX_DISTANCE = 25000
-#   - 6GB RAM: MAX_DISTANCE = 35000 (default)
-#   - 8GB+ RAM: MAX_DISTANCE = 40000
-MAX_DISTANCE = 35000
+# Jobs that fit are queued by the memory scheduler (see MEMORY_BUDGET_MB)
+# rather than rejected, but a job estimated above the whole budget is
+# refused. Keep this at a distance the budget admits for every network type
+# and poster size: with the default 4608 MB budget and MEMORY_MODEL, an
+# all_private A1 poster at 19000m is estimated at about 4380 MB, at 20000m
+# about 4790 MB. The API warns at startup if this no longer holds
+MAX_DISTANCE = 19000
 
 # Distance threshold for applying memory optimizations (meters)
 # Above this threshold, aggressive simplification is applied
@@ -25,14 +27,13 @@ MEMORY_OPTIMIZATION_THRESHOLD = 20000
 # Distance threshold for warning users (meters)
 # Users will see a warning if distance exceeds this
 # Recommended: Set 5000m below MAX_DISTANCE
-WARNING_THRESHOLD = 25000
+WARNING_THRESHOLD = 14000
 
 # Distance recommendations for different city types
 DISTANCE_RECOMMENDATIONS = {
     "small_dense": (4000, 6000),      # Venice, Amsterdam center
     "medium": (8000, 15000),           # Paris, Barcelona
-    "large_metro": (15000, 25000),     # Tokyo, Mumbai
-    "very_large": (25000, 35000)       # Maximum range
+    "large_metro": (15000, 19000)      # Tokyo, Mumbai
 }
 
 # OSMnx Settings
@@ -60,6 +61,16 @@ MAX_DPI = 300
 # Thumbnail size (pixels)
 THUMBNAIL_SIZE = 1080
 
+# Gallery image derivatives (resized previews served by /derivatives)
+# Requested widths are rounded up to one of DERIVATIVE_WIDTHS so the cache
+# holds a bounded number of variants per poster
+DERIVATIVE_WIDTHS = (320, 640, 1080)
+DERIVATIVE_DEFAULT_WIDTH = 640
+# Derivatives are cached on disk; least recently used files are removed
+# once the cache grows past this many bytes
+DERIVATIVE_CACHE_DIR = "cache/derivatives"
+DERIVATIVE_CACHE_MAX_BYTES = 512 * 1024 ** 2
+
 # Server Resource Limits
 # ----------------------
 
@@ -68,18 +79,73 @@ RECOMMENDED_MEMORY_GB = 6
 RECOMMENDED_CPU_CORES = 2
 
 # Task timeout (seconds)
-# How long to wait before killing a stuck generation task
+# Wall-clock limit per generation task (seconds). A task running longer is
+# marked failed and its worker process is killed and replaced
 TASK_TIMEOUT = 600  # 10 minutes
 
+# Worker processes are replaced after this many tasks, or once their resident
+# memory after a task exceeds WORKER_MAX_RSS_MB, so heap fragmentation from
+# earlier renders does not accumulate over long uptimes
+WORKER_MAX_JOBS = 20
+WORKER_MAX_RSS_MB = 1024
+
+# Task status store: "sqlite" keeps tasks across restarts and shares them
+# between API processes on one host (uvicorn --workers N); "memory" keeps
+# them in the API process only. Each API process runs its own worker pool
+# and memory scheduler, so divide MEMORY_BUDGET_MB by N when scaling out
+TASK_STORE = "sqlite"
+TASK_DB_FILE = "cache/tasks.db"
+
+# Finished tasks are deleted this long after they complete (seconds).
+# Unfinished tasks older than TASK_TIMEOUT * (MAX_QUEUED_TASKS + 1), e.g. left
+# behind by a killed process, are marked failed first and then deleted too
+TASK_TTL_SECONDS = 24 * 3600
+
 # Production Environment Settings
 # --------------------------------
 
 # Enable these in production for better stability
 
-# Maximum concurrent generation tasks
-# Set based on: (Total RAM - OS overhead) / Average task memory
-# Example: (6GB - 2GB) / 2GB = 2 concurrent tasks
-MAX_CONCURRENT_TASKS = 2
+# Maximum worker processes. How many jobs actually run at once is decided
+# by MEMORY_BUDGET_MB below; this only caps CPU oversubscription
+MAX_CONCURRENT_TASKS = 4
+
+# Tasks allowed to wait for a free worker; /generate answers 503 beyond this
+MAX_QUEUED_TASKS = 8
+
+# Memory-aware scheduling
+# -----------------------
+
+# Jobs start only while the sum of their estimated peak memory fits this
+# budget (MB); the rest wait in submission order. Leave room for the OS,
+# the API process and idle workers. Jobs estimated above the whole budget
+# are rejected.
+MEMORY_BUDGET_MB = RECOMMENDED_MEMORY_GB * 1024 - 1536
+
+# Peak memory model for one job (MB). base_mb, mb_per_km2 and
+# mb_per_megapixel were fitted to the peak RSS of CLI renders of 2-6 km
+# (drive network, A4, 376-728 MB peak) on a synthetic street grid; the
+# network factors are rough edge-count ratios, not measured. Larger areas
+# are a linear extrapolation until the calibration below has seen real jobs.
+#
+#   base_mb + (2 * distance_km)² * mb_per_km2 * network_factors[network_type]
+#           + poster megapixels at 300 DPI * mb_per_megapixel
+# Estimates are scaled by the ratio of observed to estimated peaks of recent
+# jobs, stored in MEMORY_CALIBRATION_FILE
+MEMORY_MODEL = {
+    "base_mb": 350,
+    "mb_per_km2": 1.0,
+    "network_factors": {
+        "drive": 1.0,
+        "drive_service": 1.3,
+        "bike": 1.6,
+        "walk": 2.2,
+        "all": 2.5,
+        "all_private": 2.6,
+    },
+    "mb_per_megapixel": 4,
+}
+MEMORY_CALIBRATION_FILE = "cache/memory_calibration.json"
 
 # Rate limiting (requests per minute)
 RATE_LIMIT_PER_MINUTE = 10
@@ -3,7 +3,7 @@ FastAPI Backend for Justlogo Map Poster Generator
 简化版本：使用内存队列，无需 Redis
 """
 
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
@@ -14,8 +14,10 @@ import uuid
 import json
 import os
 import sys
+import hashlib
 from datetime import datetime
-from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import threading
 import asyncio
 from pathlib import Path
 
@@ -27,24 +29,51 @@ sys.path.append(str(PROJECT_ROOT))
 try:
     from web.backend.config import (
         MAX_DISTANCE, WARNING_THRESHOLD, DISTANCE_RECOMMENDATIONS,
-        POSTER_SIZES, DEFAULT_POSTER_SIZE
+        POSTER_SIZES, DEFAULT_POSTER_SIZE,
+        DERIVATIVE_WIDTHS, DERIVATIVE_DEFAULT_WIDTH,
+        DERIVATIVE_CACHE_DIR, DERIVATIVE_CACHE_MAX_BYTES,
+        MAX_CONCURRENT_TASKS, MAX_QUEUED_TASKS,
+        TASK_TIMEOUT, WORKER_MAX_JOBS, WORKER_MAX_RSS_MB,
+        TASK_STORE, TASK_DB_FILE, TASK_TTL_SECONDS,
+        MEMORY_BUDGET_MB, MEMORY_MODEL, MEMORY_CALIBRATION_FILE
     )
 except ImportError:
     # Fallback defaults if config.py doesn't exist
-    MAX_DISTANCE = 35000
-    WARNING_THRESHOLD = 25000
+    MAX_DISTANCE = 19000
+    WARNING_THRESHOLD = 14000
     DISTANCE_RECOMMENDATIONS = None
     POSTER_SIZES = {"12x16": (12, 16, "12×16 inch")}
     DEFAULT_POSTER_SIZE = "12x16"
+    DERIVATIVE_WIDTHS = (320, 640, 1080)
+    DERIVATIVE_DEFAULT_WIDTH = 640
+    DERIVATIVE_CACHE_DIR = "cache/derivatives"
+    DERIVATIVE_CACHE_MAX_BYTES = 512 * 1024 ** 2
+    MAX_CONCURRENT_TASKS = 4
+    MAX_QUEUED_TASKS = 8
+    TASK_TIMEOUT = 600
+    WORKER_MAX_JOBS = 20
+    WORKER_MAX_RSS_MB = 1024
+    TASK_STORE = "sqlite"
+    TASK_DB_FILE = "cache/tasks.db"
+    TASK_TTL_SECONDS = 24 * 3600
+    MEMORY_BUDGET_MB = 4608
+    MEMORY_MODEL = {
+        "base_mb": 350,
+        "mb_per_km2": 1.0,
+        "network_factors": {"drive": 1.0, "drive_service": 1.3, "bike": 1.6, "walk": 2.2, "all": 2.5, "all_private": 2.6},
+        "mb_per_megapixel": 4,
+    }
+    MEMORY_CALIBRATION_FILE = "cache/memory_calibration.json"
 
 from create_map_poster import (
-    create_poster,
-    get_coordinates,
     load_theme,
     get_available_themes,
-    ensure_run_directories,
-    generate_output_filename
+    get_coordinates,
 )
+from web.backend.worker import generate_map_poster, init_worker, STAGE_PROGRESS
+from web.backend.scheduler import MemoryScheduler
+from web.backend.pool import WorkerPool
+from web.backend.task_store import MemoryTaskStore, SQLiteTaskStore, FINISHED_STATUSES
 
 app = FastAPI(title="Justlogo API", version="1.0.0")
 
@@ -67,14 +96,49 @@ TEMP_POSTERS_DIR = Path(__file__).parent.parent.parent / "temp_posters"
 TEMP_POSTERS_DIR.mkdir(exist_ok=True)
 app.mount("/temp_posters", StaticFiles(directory=str(TEMP_POSTERS_DIR)), name="temp_posters")
 
+# 缩略图派生图缓存（按需生成，LRU 淘汰）
+DERIVATIVE_ROOTS = {"posters": POSTERS_DIR, "temp_posters": TEMP_POSTERS_DIR}
+DERIVATIVE_CACHE_PATH = Path(DERIVATIVE_CACHE_DIR)
+if not DERIVATIVE_CACHE_PATH.is_absolute():
+    DERIVATIVE_CACHE_PATH = POSTERS_DIR.parent / DERIVATIVE_CACHE_PATH
+DERIVATIVE_FORMATS = {
+    "webp": ("WEBP", "image/webp", {"quality": 80, "method": 4}),
+    "jpeg": ("JPEG", "image/jpeg", {"quality": 85, "optimize": True}),
+}
+
 # 管理员密码（从环境变量读取，默认为 "admin123"）
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "admin123")
 
-# 内存任务存储
-TASKS: Dict[str, Dict[str, Any]] = {}
-
-# 进程池（用于异步执行地图生成）
-executor = ProcessPoolExecutor(max_workers=2)
+# 任务存储：sqlite 在重启后保留任务，并可在同一台机器的多个 API 进程间共享
+# 任务最长存活时间：排在前面的 MAX_QUEUED_TASKS 个任务逐个运行到超时，再加上自身的运行时间；
+# 超过这个时间仍未结束的任务不可能还在运行
+TASK_MAX_AGE = TASK_TIMEOUT * (MAX_QUEUED_TASKS + 1)
+if TASK_STORE == "memory":
+    TASKS = MemoryTaskStore(TASK_TTL_SECONDS, TASK_MAX_AGE)
+else:
+    TASK_DB_PATH = Path(TASK_DB_FILE)
+    if not TASK_DB_PATH.is_absolute():
+        TASK_DB_PATH = POSTERS_DIR.parent / TASK_DB_PATH
+    TASKS = SQLiteTaskStore(TASK_DB_PATH, TASK_TTL_SECONDS, TASK_MAX_AGE)
+
+# 进程池（用于执行地图生成，渲染不占用 API 进程的 GIL 和 pyplot 状态）
+# 使用 spawn：工作进程只导入轻量的 worker 模块，不继承 API 进程的线程
+MP_CONTEXT = multiprocessing.get_context("spawn")
+
+# 工作进程发回的进度事件：(task_id, progress, stage)
+PROGRESS_EVENTS = MP_CONTEXT.Queue()
+
+# 超过 TASK_TIMEOUT 的任务连同工作进程一起结束；进程完成 WORKER_MAX_JOBS 个任务
+# 或常驻内存超过 WORKER_MAX_RSS_MB 后重建，长期运行时每个进程的内存保持平稳
+WORKER_POOL = WorkerPool(
+    MAX_CONCURRENT_TASKS,
+    MP_CONTEXT,
+    initializer=init_worker,
+    initargs=(PROGRESS_EVENTS,),
+    timeout=TASK_TIMEOUT,
+    max_jobs_per_worker=WORKER_MAX_JOBS,
+    max_rss_mb=WORKER_MAX_RSS_MB
+)
 
 
 # ==================== Pydantic Models ====================
@@ -103,6 +167,7 @@ class TaskStatusResponse(BaseModel):
     task_id: str
     status: str
     progress: int  # 0-100
+    stage: Optional[str] = None  # create_map_poster.PROGRESS_STAGES 中的当前阶段
     result: Optional[Dict[str, Any]] = None
     error: Optional[str] = None
 
@@ -137,145 +202,227 @@ class PublishToGalleryRequest(BaseModel):
 
 # ==================== Helper Functions ====================
 
-def generate_map_poster(
-    task_id: str,
-    city: str,
-    country: str,
-    latitude: Optional[float],
-    longitude: Optional[float],
-    theme: str,
-    distance: int,
-    network_type: str,
-    use_svg: bool,
-    thumbnail: bool,
-    hide_attribution: bool,
-    poster_size: str
-):
-    """
-    后台任务：生成地图海报
+def apply_progress_events():
+    """
+    后台线程：把工作进程发回的进度事件写入任务记录
+    """
+    while True:
+        task_id, progress, stage = PROGRESS_EVENTS.get()
+        # 任务结束后到达的事件由存储丢弃
+        TASKS.update_progress(task_id, progress, stage)
+
+
+def finish_task(task_id: str, outcome: Optional[tuple], error: Optional[str]):
+    """
+    进程池任务结束回调：记录结果或错误（包括超时），释放内存预算
+    """
+    peak_mb = None
+    if error is not None:
+        TASKS.finish(task_id, "failed", error=error)
+        print(f"✗ Task {task_id} failed: {error}")
+    else:
+        result, peak_mb = outcome
+        TASKS.finish(task_id, "completed", progress=100, stage=None, result=result, peak_memory_mb=peak_mb)
+        task = TASKS.get(task_id)
+        if task is not None and task["job_key"]:
+            poster_file = TEMP_POSTERS_DIR / Path(result["poster_url"]).relative_to("/temp_posters")
+            TASKS.record_output(task["job_key"], str(poster_file))
+    SCHEDULER.finished(task_id, peak_mb)
+
+
+def submit_job(task_id: str, job: Dict[str, Any]):
+    """
+    把生成任务提交到进程池
     """
     try:
-        # 更新状态为处理中
-        TASKS[task_id]["status"] = "processing"
-        TASKS[task_id]["progress"] = 10
-
-        # 1. 获取坐标
-        if latitude is not None and longitude is not None:
-            coords = (latitude, longitude)
-            print(f"Using manual coordinates: {latitude}, {longitude}")
-        else:
-            TASKS[task_id]["progress"] = 20
-            coords = get_coordinates(city, country)
-
-        TASKS[task_id]["progress"] = 30
-
-        # Validate distance to prevent memory issues
-        if distance > MAX_DISTANCE:
-            recommendations = (
-                "4000-6000m for dense cities, "
-                "8000-15000m for medium cities, "
-                "15000-25000m for large metros"
-            )
-            error_msg = (
-                f"Distance {distance}m exceeds maximum allowed {MAX_DISTANCE}m. "
-                f"Please use a smaller distance to avoid memory issues. "
-                f"Recommended: {recommendations}"
-            )
-            raise ValueError(error_msg)
-
-        if distance > WARNING_THRESHOLD:
-            print(f"⚠️  Large distance ({distance}m) - applying memory optimizations")
-
-        # 2. 准备输出目录（保存到临时文件夹）
-        run_id = datetime.now().strftime("%Y%m%d_%H%M%S")
-
-        # 使用临时文件夹代替正式画廊
-        # 同一个城市使用同一个文件夹，不带时间戳
-        city_slug = city.lower().replace(' ', '_')
-        temp_run_dir = TEMP_POSTERS_DIR / city_slug
-        temp_run_dir.mkdir(parents=True, exist_ok=True)
-
-        temp_thumbnails_dir = temp_run_dir / "thumbnails"
-        temp_thumbnails_dir.mkdir(exist_ok=True)
-
-        temp_collages_dir = temp_thumbnails_dir / "collages"
-        temp_collages_dir.mkdir(exist_ok=True)
-
-        TASKS[task_id]["progress"] = 40
-
-        # 3. 生成海报
-        output_file = temp_run_dir / f"{theme}_{run_id}.{'svg' if use_svg else 'png'}"
-
-        TASKS[task_id]["progress"] = 50
-
-        # 获取海报尺寸
-        size_tuple = POSTER_SIZES.get(poster_size, POSTER_SIZES[DEFAULT_POSTER_SIZE])[:2]
-
-        # 调用原始的 create_poster 函数
-        thumbnail_collector = [] if thumbnail else None
-        create_poster(
-            city=city,
-            country=country,
-            point=coords,
-            dist=distance,
-            output_file=str(output_file),
-            network_type=network_type,
-            make_thumbnail=thumbnail,
-            thumbnails_dir=str(temp_thumbnails_dir) if thumbnail else None,
-            thumbnail_collector=thumbnail_collector,
-            show_attribution=not hide_attribution,
-            use_svg=use_svg,
-            theme_name=theme,
-            poster_size=size_tuple
-        )
+        WORKER_POOL.submit(task_id, generate_map_poster, (task_id, job), finish_task)
+    except RuntimeError as e:
+        # 进程池已关闭（服务正在停止）
+        TASKS.finish(task_id, "failed", error=str(e))
+        SCHEDULER.finished(task_id)
+
+
+# 内存感知调度：估算峰值内存之和不超过预算时才把任务交给进程池
+MEMORY_CALIBRATION_PATH = Path(MEMORY_CALIBRATION_FILE)
+if not MEMORY_CALIBRATION_PATH.is_absolute():
+    MEMORY_CALIBRATION_PATH = POSTERS_DIR.parent / MEMORY_CALIBRATION_PATH
+SCHEDULER = MemoryScheduler(
+    MEMORY_BUDGET_MB,
+    MAX_CONCURRENT_TASKS,
+    submit_job,
+    MEMORY_MODEL,
+    MEMORY_CALIBRATION_PATH
+)
 
-        TASKS[task_id]["progress"] = 90
+# MAX_DISTANCE 以内的请求不应因超出预算被拒绝：按最大海报和最耗内存的路网检查一次
+_largest_size = max(POSTER_SIZES.values(), key=lambda size: size[0] * size[1])
+_largest_estimate = SCHEDULER.raw_estimate({
+    "distance": MAX_DISTANCE,
+    "network_type": max(MEMORY_MODEL["network_factors"], key=MEMORY_MODEL["network_factors"].get),
+    "size_tuple": _largest_size[:2],
+})
+if _largest_estimate > MEMORY_BUDGET_MB:
+    print(
+        f"⚠ MAX_DISTANCE {MAX_DISTANCE}m needs up to {_largest_estimate:.0f} MB, more than "
+        f"MEMORY_BUDGET_MB {MEMORY_BUDGET_MB} MB; some requests within it will be rejected"
+    )
 
-        # 保存元数据到 JSON 文件
-        metadata = {
-            "poster_size": poster_size,
-            "size_label": POSTER_SIZES.get(poster_size, POSTER_SIZES[DEFAULT_POSTER_SIZE])[2],
-            "city": city,
-            "country": country,
-            "theme": theme,
-            "distance": distance,
-            "network_type": network_type,
-            "format": "svg" if use_svg else "png",
-            "created_at": run_id
-        }
-        metadata_file = temp_run_dir / f"{theme}_{run_id}.json"
-        with open(metadata_file, 'w') as f:
-            import json
-            json.dump(metadata, f, indent=2)
-
-        # 4. 构建结果（指向临时文件夹）
-        poster_url = f"/temp_posters/{temp_run_dir.name}/{output_file.name}"
-        thumb_url = None
-        if thumbnail and thumbnail_collector:
-            thumb_url = f"/temp_posters/{temp_run_dir.name}/thumbnails/{Path(thumbnail_collector[0]).name}"
-
-        TASKS[task_id]["status"] = "completed"
-        TASKS[task_id]["progress"] = 100
-        TASKS[task_id]["result"] = {
-            "poster_url": poster_url,
-            "thumbnail_url": thumb_url,
-            "city": city,
-            "country": country,
-            "theme": theme,
-            "coords": coords,
-            "created_at": run_id,
-            "poster_size": poster_size,
-            "size_label": POSTER_SIZES.get(poster_size, POSTER_SIZES[DEFAULT_POSTER_SIZE])[2]
-        }
 
-        print(f"✓ Task {task_id} completed successfully")
+def canonical_job_key(job: Dict[str, Any]) -> str:
+    """
+    生成结果相同的请求得到相同的 key：城市和国家名（写在海报上）、
+    坐标四舍五入到约 10 米、主题、范围、路网、格式和尺寸
+    """
+    canonical = {
+        "city": " ".join(job["city"].split()).casefold(),
+        "country": " ".join(job["country"].split()).casefold(),
+        "coords": [round(job["latitude"], 4), round(job["longitude"], 4)],
+        "theme": job["theme"],
+        "distance": job["distance"],
+        "network_type": job["network_type"],
+        "format": "svg" if job["use_svg"] else "png",
+        "thumbnail": job["thumbnail"],
+        "hide_attribution": job["hide_attribution"],
+        "size": list(job["size_tuple"]),
+    }
+    return hashlib.sha1(json.dumps(canonical, sort_keys=True).encode()).hexdigest()[:20]
+
+
+def record_outputs(directory: Path):
+    """
+    把目录下带 job_key 的海报写入任务存储的输出记录
+    """
+    for metadata_file in directory.glob("**/*.json"):
+        try:
+            with open(metadata_file, 'r') as f:
+                metadata = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if isinstance(metadata, dict) and metadata.get("job_key") and metadata.get("format"):
+            TASKS.record_output(metadata["job_key"], str(metadata_file.with_suffix(f".{metadata['format']}")))
+
+
+def find_existing_output(job_key: str) -> Optional[Dict[str, Any]]:
+    """
+    查找相同请求已经生成的海报，返回与任务结果相同结构的字典
+    输出记录在任务完成和发布时增量更新，所有 API 进程共享
+    """
+    poster_file = TASKS.find_output(job_key)
+    if poster_file is None:
+        return None
+    poster_file = Path(poster_file)
+    try:
+        with open(poster_file.with_suffix(".json"), 'r') as f:
+            metadata = json.load(f)
+    except (OSError, ValueError):
+        metadata = None
+    if metadata is None or not poster_file.exists():
+        # 文件已被删除
+        TASKS.forget_output(job_key)
+        return None
+
+    root = "posters" if poster_file.is_relative_to(POSTERS_DIR) else "temp_posters"
+    relative_path = poster_file.relative_to(DERIVATIVE_ROOTS[root])
+    thumb_file = poster_file.parent / "thumbnails" / f"{poster_file.stem}.jpg"
+    return {
+        "poster_url": f"/{root}/{relative_path.as_posix()}",
+        "thumbnail_url": f"/{root}/{relative_path.parent.as_posix()}/thumbnails/{thumb_file.name}" if thumb_file.exists() else None,
+        "city": metadata["city"],
+        "country": metadata["country"],
+        "theme": metadata["theme"],
+        "coords": (metadata["latitude"], metadata["longitude"]),
+        "created_at": metadata["created_at"],
+        "poster_size": metadata["poster_size"],
+        "size_label": metadata["size_label"],
+    }
+
+
+def derivative_url(root: str, relative_path: str, width: int = DERIVATIVE_DEFAULT_WIDTH) -> str:
+    """
+    海报缩略图的派生图地址（由 /derivatives 按需生成并缓存）
+    """
+    return f"/derivatives/{root}/{relative_path}?width={width}"
 
-    except Exception as e:
-        TASKS[task_id]["status"] = "failed"
-        TASKS[task_id]["error"] = str(e)
-        print(f"✗ Task {task_id} failed: {e}")
-        import traceback
-        traceback.print_exc()
+
+def preview_url(root: str, poster_file: Path, width: int = DERIVATIVE_DEFAULT_WIDTH) -> Optional[str]:
+    """
+    海报的预览图地址：位图海报和带缩略图的 SVG 走派生图，
+    没有缩略图的 SVG 返回 None（矢量原图本身就很小）
+    """
+    thumb_file = poster_file.parent / "thumbnails" / f"{poster_file.stem}.jpg"
+    if poster_file.suffix == ".svg" and not thumb_file.exists():
+        return None
+    relative_path = poster_file.relative_to(DERIVATIVE_ROOTS[root]).as_posix()
+    return derivative_url(root, relative_path, width)
+
+
+def resolve_derivative_source(poster_file: Path, width: int) -> Optional[Path]:
+    """
+    选择生成派生图的源文件：渲染时生成的缩略图足够宽时优先使用（解码快得多），
+    否则使用海报原图；SVG 只能使用缩略图
+    """
+    from PIL import Image
+
+    thumb_file = poster_file.parent / "thumbnails" / f"{poster_file.stem}.jpg"
+    if thumb_file.exists():
+        with Image.open(thumb_file) as img:
+            if img.width >= width or poster_file.suffix == ".svg":
+                return thumb_file
+    if poster_file.suffix in (".png", ".jpg", ".jpeg"):
+        return poster_file
+    return None
+
+
+def evict_derivatives(max_bytes: int = DERIVATIVE_CACHE_MAX_BYTES):
+    """
+    删除最久未使用的派生图，直到缓存目录小于 max_bytes（mtime 记录最近使用时间）
+    """
+    entries = []
+    # 只统计已完成的派生图：其他请求正在写入的 *.tmp 文件不能删除
+    finished = (path for image_format in DERIVATIVE_FORMATS for path in DERIVATIVE_CACHE_PATH.glob(f"*/*.{image_format}"))
+    for path in finished:
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, path, stat.st_size))
+
+    total = sum(size for _, _, size in entries)
+    for _, path, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+
+
+def build_derivative(source: Path, width: int, image_format: str) -> Path:
+    """
+    返回 source 缩放到 width 后的派生图路径，缓存命中时直接返回
+    """
+    from PIL import Image
+
+    stat = source.stat()
+    key = hashlib.sha1(
+        f"{source.resolve()}:{stat.st_mtime_ns}:{stat.st_size}:{width}:{image_format}".encode("utf-8")
+    ).hexdigest()
+    cache_file = DERIVATIVE_CACHE_PATH / key[:2] / f"{key}.{image_format}"
+    if cache_file.exists():
+        # 更新 mtime，作为 LRU 的最近使用时间
+        os.utime(cache_file)
+        return cache_file
+
+    pil_format, _, save_options = DERIVATIVE_FORMATS[image_format]
+    with Image.open(source) as img:
+        # thumbnail() 会先用 draft/reduce 粗缩，再用 LANCZOS 精缩
+        img.thumbnail((width, width * 4), Image.LANCZOS, reducing_gap=3.0)
+        img = img.convert("RGB")
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        # 先写临时文件再原子替换，避免并发请求读到半个文件
+        temp_file = cache_file.with_name(f"{cache_file.name}.{uuid.uuid4().hex}.tmp")
+        img.save(temp_file, format=pil_format, **save_options)
+    os.replace(temp_file, cache_file)
+    evict_derivatives()
+    return cache_file
 
 
 def scan_posters_directory() -> List[Dict[str, Any]]:
@@ -309,18 +456,10 @@ def scan_posters_directory() -> List[Dict[str, Any]]:
         else:
             timestamp = "00000000_000000"
 
-        # 优先使用第一个海报的缩略图作为预览图
+        # 第一个海报的缩小派生图作为预览图（没有缩略图的 SVG 直接使用原图）
         preview_image = None
         if poster_files:
-            thumbnails_dir = city_dir / "thumbnails"
-            if thumbnails_dir.exists():
-                # 查找第一个海报对应的缩略图
-                first_poster_stem = poster_files[0].stem
-                thumb_file = thumbnails_dir / f"{first_poster_stem}.jpg"
-                if thumb_file.exists():
-                    preview_image = f"/posters/{city_dir.name}/thumbnails/{thumb_file.name}"
-
-            # 如果没有找到缩略图，使用原图
+            preview_image = preview_url("posters", poster_files[0])
             if not preview_image:
                 preview_image = f"/posters/{city_dir.name}/{poster_files[0].name}"
 
@@ -372,11 +511,8 @@ def get_city_posters(city_slug: str) -> List[Dict[str, Any]]:
             theme_name = poster_file.stem
             timestamp = datetime.fromtimestamp(poster_file.stat().st_mtime).strftime("%Y%m%d_%H%M%S")
 
-        # 查找对应的缩略图
-        thumb_path = city_dir / "thumbnails" / f"{poster_file.stem}.jpg"
-        thumb_url = None
-        if thumb_path.exists():
-            thumb_url = f"/posters/{city_dir.name}/thumbnails/{thumb_path.name}"
+        # 缩略图使用按需生成的派生图
+        thumb_url = preview_url("posters", poster_file)
 
         # Try to load metadata if exists
         metadata_path = poster_file.parent / f"{poster_file.stem}.json"
@@ -434,44 +570,121 @@ async def get_poster_sizes():
     return {"sizes": sizes, "default": DEFAULT_POSTER_SIZE}
 
 
+async def admit_job(task_id: str, job: Dict[str, Any]) -> TaskResponse:
+    """
+    坐标已解析的任务：复用已有海报、挂到正在运行的相同任务上，或交给调度器
+    排队已满时返回 status "busy"（由调用方决定如何处理）
+    """
+    job_key = job["job_key"] = canonical_job_key(job)
+    TASKS.update(task_id, job_key=job_key)
+
+    existing = await asyncio.to_thread(find_existing_output, job_key)
+    if existing is not None:
+        TASKS.finish(task_id, "completed", progress=100, result=existing)
+        return TaskResponse(task_id=task_id, status="completed", message="Identical poster already generated")
+
+    primary_id = TASKS.find_running(job_key)
+    if primary_id is not None and primary_id != task_id:
+        # 状态查询时跟随正在运行的相同任务，该任务结束时同步结果
+        TASKS.attach(task_id, primary_id)
+        return TaskResponse(task_id=task_id, status="pending", message="Attached to an identical running task")
+
+    if SCHEDULER.waiting_count >= MAX_QUEUED_TASKS:
+        return TaskResponse(task_id=task_id, status="busy", message="Server is busy, please try again later")
+
+    try:
+        estimate = SCHEDULER.submit(task_id, job)
+    except ValueError as e:
+        TASKS.finish(task_id, "failed", error=str(e))
+        return TaskResponse(task_id=task_id, status="failed", message=str(e))
+    TASKS.update(task_id, estimated_memory_mb=round(estimate))
+    return TaskResponse(task_id=task_id, status="pending", message="Task created successfully")
+
+
+# 后台地理编码任务（保存引用，避免 asyncio 任务被回收）
+GEOCODE_TASKS = set()
+
+
+async def geocode_and_admit(task_id: str, job: Dict[str, Any]):
+    """
+    后台阶段：解析城市坐标后再去重和排队；Nominatim 限流和重试可能需要几十秒，
+    不能占用 /generate 请求
+    """
+    try:
+        job["latitude"], job["longitude"] = await asyncio.to_thread(get_coordinates, job["city"], job["country"])
+        response = await admit_job(task_id, job)
+    except Exception as e:
+        TASKS.finish(task_id, "failed", error=str(e))
+        return
+    if response.status == "busy":
+        TASKS.finish(task_id, "failed", error=response.message)
+
+
 @app.post("/generate", response_model=TaskResponse)
-async def generate(request: GenerateRequest, background_tasks: BackgroundTasks):
+async def generate(request: GenerateRequest):
     """
-    创建地图生成任务
+    创建地图生成任务（按内存预算调度到进程池，排队任务数有上限）
+    相同的请求复用已有海报，或挂到正在运行的相同任务上；
+    只给出城市名时立即返回 task_id，地理编码作为任务的第一个阶段在后台进行
     """
+    if SCHEDULER.waiting_count >= MAX_QUEUED_TASKS:
+        raise HTTPException(status_code=503, detail="Server is busy, please try again later")
+
     task_id = str(uuid.uuid4())
 
     # 初始化任务状态
-    TASKS[task_id] = {
-        "status": "pending",
-        "progress": 0,
-        "result": None,
-        "error": None,
-        "created_at": datetime.now().isoformat()
+    TASKS.create(task_id)
+
+    # 限制下载范围；内存由调度器按估算控制
+    if request.distance > MAX_DISTANCE:
+        recommendations = (
+            "4000-6000m for dense cities, "
+            "8000-15000m for medium cities, "
+            "15000-19000m for large metros"
+        )
+        error = (
+            f"Distance {request.distance}m exceeds maximum allowed {MAX_DISTANCE}m. "
+            f"Please use a smaller distance. "
+            f"Recommended: {recommendations}"
+        )
+        TASKS.finish(task_id, "failed", error=error)
+        return TaskResponse(task_id=task_id, status="failed", message=error)
+
+    if request.distance > WARNING_THRESHOLD:
+        print(f"⚠️  Large distance ({request.distance}m) - download may take a while")
+
+    # 获取海报尺寸
+    size = POSTER_SIZES.get(request.poster_size, POSTER_SIZES[DEFAULT_POSTER_SIZE])
+    job = {
+        "city": request.city,
+        "country": request.country,
+        "latitude": request.latitude,
+        "longitude": request.longitude,
+        "theme": request.theme,
+        "distance": request.distance,
+        "network_type": request.network_type,
+        "use_svg": request.format == "svg",
+        "thumbnail": request.thumbnail,
+        "hide_attribution": request.hide_attribution,
+        "poster_size": request.poster_size,
+        "size_tuple": size[:2],
+        "size_label": size[2],
+        "temp_posters_dir": str(TEMP_POSTERS_DIR),
     }
 
-    # 添加后台任务
-    background_tasks.add_task(
-        generate_map_poster,
-        task_id=task_id,
-        city=request.city,
-        country=request.country,
-        latitude=request.latitude,
-        longitude=request.longitude,
-        theme=request.theme,
-        distance=request.distance,
-        network_type=request.network_type,
-        use_svg=(request.format == "svg"),
-        thumbnail=request.thumbnail,
-        hide_attribution=request.hide_attribution,
-        poster_size=request.poster_size
-    )
+    # 去重 key 需要坐标：没有给出坐标时先在后台地理编码
+    if job["latitude"] is None or job["longitude"] is None:
+        TASKS.update_progress(task_id, STAGE_PROGRESS["geocode"], "geocode")
+        geocode_task = asyncio.create_task(geocode_and_admit(task_id, job))
+        GEOCODE_TASKS.add(geocode_task)
+        geocode_task.add_done_callback(GEOCODE_TASKS.discard)
+        return TaskResponse(task_id=task_id, status="pending", message="Task created successfully")
 
-    return TaskResponse(
-        task_id=task_id,
-        status="pending",
-        message="Task created successfully"
-    )
+    response = await admit_job(task_id, job)
+    if response.status == "busy":
+        TASKS.delete(task_id)
+        raise HTTPException(status_code=503, detail=response.message)
+    return response
 
 
 @app.get("/task/{task_id}", response_model=TaskStatusResponse)
@@ -479,17 +692,21 @@ async def get_task_status(task_id: str):
     """
     查询任务状态
     """
-    if task_id not in TASKS:
+    task = TASKS.get(task_id)
+    if task is None:
         raise HTTPException(status_code=404, detail="Task not found")
 
-    task = TASKS[task_id]
+    # 挂到相同任务上的请求在运行期间返回该任务的进度
+    if task["attached_to"] and task["status"] not in FINISHED_STATUSES:
+        task = TASKS.get(task["attached_to"]) or task
 
     return TaskStatusResponse(
         task_id=task_id,
         status=task["status"],
         progress=task["progress"],
-        result=task.get("result"),
-        error=task.get("error")
+        stage=task["stage"],
+        result=task["result"],
+        error=task["error"]
     )
 
 
@@ -561,6 +778,40 @@ async def get_city_detail(city_slug: str):
     }
 
 
+@app.get("/derivatives/{root}/{poster_path:path}")
+def get_derivative(root: str, poster_path: str, width: int = DERIVATIVE_DEFAULT_WIDTH, format: str = "webp"):
+    """
+    按需生成海报的缩小派生图（JPEG/WebP），磁盘缓存
+    宽度向上取整到 DERIVATIVE_WIDTHS 中的一档
+    """
+    if root not in DERIVATIVE_ROOTS:
+        raise HTTPException(status_code=404, detail="Unknown poster root")
+    if format not in DERIVATIVE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format, use one of: {', '.join(DERIVATIVE_FORMATS)}")
+
+    # 防止路径穿越
+    root_dir = DERIVATIVE_ROOTS[root].resolve()
+    poster_file = (root_dir / poster_path).resolve()
+    if not poster_file.is_relative_to(root_dir) or not poster_file.is_file():
+        raise HTTPException(status_code=404, detail="Poster not found")
+
+    width = next((w for w in sorted(DERIVATIVE_WIDTHS) if w >= width), max(DERIVATIVE_WIDTHS))
+    source = resolve_derivative_source(poster_file, width)
+    if source is None:
+        raise HTTPException(status_code=415, detail="No raster source for this poster")
+
+    try:
+        cache_file = build_derivative(source, width, format)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to create derivative: {str(e)}")
+
+    return FileResponse(
+        cache_file,
+        media_type=DERIVATIVE_FORMATS[format][1],
+        headers={"Cache-Control": "public, max-age=86400"}
+    )
+
+
 @app.post("/verify-password")
 async def verify_password(request: VerifyPasswordRequest):
     """
@@ -608,6 +859,9 @@ async def publish_to_gallery(request: PublishToGalleryRequest):
                 # 文件：直接复制（如果存在则覆盖）
                 shutil.copy2(item, dest_item)
 
+        # 之后相同的请求指向已发布的海报
+        record_outputs(gallery_city_dir)
+
         return {
             "success": True,
             "message": "Poster published to gallery successfully",
@@ -617,6 +871,28 @@ async def publish_to_gallery(request: PublishToGalleryRequest):
         raise HTTPException(status_code=500, detail=f"Failed to publish poster: {str(e)}")
 
 
+@app.on_event("startup")
+async def start_progress_listener():
+    """
+    启动进度事件监听线程，并把重启前中断的任务标记为失败
+    """
+    threading.Thread(target=apply_progress_events, name="progress-events", daemon=True).start()
+    # 输出记录只在启动时从目录重建一次（收录升级前生成的海报）；画廊后写入，优先于临时海报
+    threading.Thread(
+        target=lambda: (record_outputs(TEMP_POSTERS_DIR), record_outputs(POSTERS_DIR)),
+        name="record-outputs",
+        daemon=True
+    ).start()
+    orphaned = TASKS.fail_orphaned("Task was interrupted by a server restart")
+    if orphaned:
+        print(f"⚠ Marked {orphaned} interrupted task(s) as failed")
+
+
+@app.on_event("shutdown")
+async def shutdown_worker_pool():
+    WORKER_POOL.shutdown()
+
+
 @app.get("/health")
 async def health_check():
     """
@@ -0,0 +1,229 @@
+"""
+地图生成的工作进程池
+与 ProcessPoolExecutor 不同，可以单独结束某个工作进程：
+任务超过墙钟时限时杀掉并替换进程；进程完成一定数量的任务或常驻内存超过阈值后退役重建，
+避免长期运行的进程积累堆碎片
+"""
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from collections import deque
+from multiprocessing.connection import wait
+import threading
+import time
+
+
+def worker_main(conn, initializer: Optional[Callable] = None, initargs: Tuple = ()):
+    """
+    工作进程主循环：接收 (task_id, fn, args) 并执行，发回 (task_id, ok, result 或错误信息)
+    收到 None 时退出
+    """
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        task_id, fn, args = message
+        try:
+            conn.send((task_id, True, fn(*args)))
+        except Exception as e:
+            conn.send((task_id, False, str(e)))
+
+
+def process_rss_mb(pid: int) -> Optional[float]:
+    """
+    进程当前的常驻内存（MB），非 Linux 平台返回 None
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class Worker:
+    """
+    一个工作进程及其当前任务
+    """
+
+    def __init__(self, context, initializer, initargs):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=worker_main,
+            args=(child_conn, initializer, initargs),
+            daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.jobs_done = 0
+        self.task_id: Optional[str] = None
+        self.callback: Optional[Callable] = None
+        self.deadline: Optional[float] = None
+
+    def start(self, task_id: str, fn: Callable, args: Tuple, callback: Callable, timeout: Optional[float]):
+        self.task_id = task_id
+        self.callback = callback
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.conn.send((task_id, fn, args))
+
+    def finish(self) -> Tuple[str, Callable]:
+        task = (self.task_id, self.callback)
+        self.task_id = self.callback = self.deadline = None
+        self.jobs_done += 1
+        return task
+
+    def stop(self, kill: bool = False):
+        """
+        结束进程：正常退役时先请求退出，超时或卡死时直接终止
+        """
+        if not kill:
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+            self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(5)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class WorkerPool:
+    """
+    固定上限的工作进程池
+    submit(task_id, fn, args, callback) 排队一个任务，结束后在监控线程中调用
+    callback(task_id, result, error)，成功时 error 为 None
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        context,
+        initializer: Optional[Callable] = None,
+        initargs: Tuple = (),
+        timeout: Optional[float] = None,
+        max_jobs_per_worker: Optional[int] = None,
+        max_rss_mb: Optional[float] = None
+    ):
+        self.max_workers = max_workers
+        self.context = context
+        self.initializer = initializer
+        self.initargs = initargs
+        self.timeout = timeout
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.max_rss_mb = max_rss_mb
+        self.lock = threading.Lock()
+        self.pending = deque()  # (task_id, fn, args, callback)
+        self.idle: List[Worker] = []
+        self.busy: Dict[Any, Worker] = {}  # conn -> worker
+        self.closed = False
+        self.monitor = threading.Thread(target=self._monitor, daemon=True)
+        self.monitor.start()
+
+    def submit(self, task_id: str, fn: Callable, args: Tuple, callback: Callable):
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Worker pool is shut down")
+            self.pending.append((task_id, fn, args, callback))
+            self._assign()
+
+    def _assign(self):
+        # 调用方持有 self.lock
+        while self.pending and (self.idle or len(self.busy) < self.max_workers):
+            worker = self.idle.pop() if self.idle else Worker(self.context, self.initializer, self.initargs)
+            task_id, fn, args, callback = self.pending.popleft()
+            try:
+                worker.start(task_id, fn, args, callback, self.timeout)
+            except OSError:
+                # 空闲进程已经退出：换一个新进程重试
+                worker.stop(kill=True)
+                self.pending.appendleft((task_id, fn, args, callback))
+                continue
+            self.busy[worker.conn] = worker
+
+    def _should_retire(self, worker: Worker) -> Optional[str]:
+        if self.max_jobs_per_worker and worker.jobs_done >= self.max_jobs_per_worker:
+            return f"after {worker.jobs_done} jobs"
+        if self.max_rss_mb:
+            rss = process_rss_mb(worker.process.pid)
+            if rss is not None and rss > self.max_rss_mb:
+                return f"at {rss:.0f} MB RSS"
+        return None
+
+    def _monitor(self):
+        """
+        监控线程：收集结果，处理超时和意外退出的进程，按需回收进程
+        """
+        while True:
+            with self.lock:
+                if self.closed:
+                    return
+                busy = list(self.busy.values())
+            waitables = [w.conn for w in busy] + [w.process.sentinel for w in busy]
+            ready = set(wait(waitables, timeout=1.0)) if waitables else set()
+            if not waitables:
+                time.sleep(0.2)
+
+            finished = []  # (callback, task_id, result, error)
+            to_stop = []  # (worker, kill)
+            with self.lock:
+                now = time.monotonic()
+                for worker in busy:
+                    if worker.conn not in self.busy:
+                        continue
+                    if worker.conn in ready:
+                        try:
+                            task_id, ok, value = worker.conn.recv()
+                        except (EOFError, OSError):
+                            ok = None
+                        if ok is not None:
+                            del self.busy[worker.conn]
+                            task_id, callback = worker.finish()
+                            finished.append((callback, task_id, value if ok else None, None if ok else value))
+                            reason = self._should_retire(worker)
+                            if reason:
+                                print(f"♻ Recycling worker {worker.process.pid} {reason}")
+                                to_stop.append((worker, False))
+                            else:
+                                self.idle.append(worker)
+                            continue
+                    if worker.process.sentinel in ready or not worker.process.is_alive():
+                        worker.process.join(1)
+                        error = f"Worker process exited unexpectedly (exit code {worker.process.exitcode})"
+                    elif worker.deadline is not None and now > worker.deadline:
+                        error = f"Task timed out after {self.timeout:.0f}s"
+                    else:
+                        continue
+                    print(f"✗ Task {worker.task_id}: {error}, replacing worker {worker.process.pid}")
+                    del self.busy[worker.conn]
+                    task_id, callback = worker.finish()
+                    to_stop.append((worker, True))
+                    finished.append((callback, task_id, None, error))
+                self._assign()
+
+            # 在锁外结束进程和回调：join 可能要等几秒，回调中可能再次 submit
+            for worker, kill in to_stop:
+                worker.stop(kill=kill)
+            for callback, task_id, result, error in finished:
+                try:
+                    callback(task_id, result, error)
+                except Exception as e:
+                    print(f"⚠ Task {task_id} callback failed: {e}")
+
+    def shutdown(self):
+        """
+        停止所有工作进程；运行中的任务直接终止
+        """
+        with self.lock:
+            self.closed = True
+            workers = self.idle + list(self.busy.values())
+            self.idle, self.busy = [], {}
+            self.pending.clear()
+        for worker in workers:
+            worker.stop(kill=worker.task_id is not None)
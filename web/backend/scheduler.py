@@ -0,0 +1,146 @@
+"""
+按内存预算调度地图生成任务
+每个任务的峰值内存由 distance、network_type 和 poster_size 估算，并用实际运行的峰值校准；
+运行中任务的估算之和不超过预算时才启动下一个任务，其余任务按提交顺序排队
+"""
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from collections import deque
+from pathlib import Path
+import json
+import threading
+
+from create_map_poster import POSTER_DPI
+
+
+class MemoryScheduler:
+    """
+    内存感知的任务准入：start_job(task_id, job) 启动任务，任务结束后调用 finished()
+    """
+
+    # 校准：保留最近的 实际峰值/模型估算 比例，至少有 min_samples 个样本后才使用
+    max_samples = 50
+    min_samples = 3
+    # 取比例的高分位数，宁可高估也不要 OOM
+    quantile = 0.9
+    scale_limits = (0.25, 4.0)
+
+    def __init__(
+        self,
+        budget_mb: float,
+        max_running: int,
+        start_job: Callable[[str, Dict[str, Any]], None],
+        model: Dict[str, Any],
+        calibration_file: Optional[Path] = None
+    ):
+        self.budget_mb = budget_mb
+        self.max_running = max_running
+        self.start_job = start_job
+        self.model = model
+        self.calibration_file = calibration_file
+        self.lock = threading.Lock()
+        self.waiting = deque()  # (task_id, job, raw_estimate)
+        self.running: Dict[str, Tuple[float, float]] = {}  # task_id -> (raw_estimate, estimate)
+        self.ratios: List[float] = self._load_calibration()
+
+    def _load_calibration(self) -> List[float]:
+        if self.calibration_file is None or not self.calibration_file.exists():
+            return []
+        try:
+            with open(self.calibration_file, 'r') as f:
+                return [float(r) for r in json.load(f)["ratios"]][-self.max_samples:]
+        except (OSError, ValueError, KeyError, TypeError):
+            return []
+
+    def _save_calibration(self):
+        if self.calibration_file is None:
+            return
+        try:
+            self.calibration_file.parent.mkdir(parents=True, exist_ok=True)
+            temp_file = self.calibration_file.with_suffix(".tmp")
+            with open(temp_file, 'w') as f:
+                json.dump({"ratios": self.ratios}, f)
+            temp_file.replace(self.calibration_file)
+        except OSError as e:
+            print(f"⚠ Failed to save memory calibration: {e}")
+
+    def raw_estimate(self, job: Dict[str, Any]) -> float:
+        """
+        未校准的峰值内存估算（MB）：基础开销 + 地图面积 × 路网系数 + 海报像素
+        """
+        model = self.model
+        area_km2 = (2 * job["distance"] / 1000) ** 2
+        network_factor = model["network_factors"].get(job["network_type"], max(model["network_factors"].values()))
+        width, height = job["size_tuple"]
+        megapixels = width * height * POSTER_DPI ** 2 / 1e6
+        return (
+            model["base_mb"]
+            + area_km2 * model["mb_per_km2"] * network_factor
+            + megapixels * model["mb_per_megapixel"]
+        )
+
+    def scale(self) -> float:
+        """
+        校准系数：最近实际峰值与模型估算之比的高分位数
+        """
+        if len(self.ratios) < self.min_samples:
+            return 1.0
+        ratios = sorted(self.ratios)
+        value = ratios[min(len(ratios) - 1, int(self.quantile * len(ratios)))]
+        return min(max(value, self.scale_limits[0]), self.scale_limits[1])
+
+    def estimate(self, job: Dict[str, Any]) -> float:
+        return self.raw_estimate(job) * self.scale()
+
+    @property
+    def used_mb(self) -> float:
+        return sum(estimate for _, estimate in self.running.values())
+
+    @property
+    def waiting_count(self) -> int:
+        return len(self.waiting)
+
+    def submit(self, task_id: str, job: Dict[str, Any]) -> float:
+        """
+        排队一个任务并尽可能启动；返回估算的峰值内存（MB）
+        估算超过整个预算的任务无法安全运行，抛出 ValueError
+        """
+        raw = self.raw_estimate(job)
+        estimate = raw * self.scale()
+        if estimate > self.budget_mb:
+            raise ValueError(
+                f"This poster needs an estimated {estimate:.0f} MB of memory, more than the server's "
+                f"budget of {self.budget_mb:.0f} MB. Please use a smaller distance or poster size."
+            )
+        with self.lock:
+            self.waiting.append((task_id, job, raw))
+        self._dispatch()
+        return estimate
+
+    def finished(self, task_id: str, peak_mb: Optional[float] = None):
+        """
+        任务结束：释放它占用的预算，记录实际峰值用于校准，然后启动排队的任务
+        """
+        with self.lock:
+            raw, _ = self.running.pop(task_id, (None, None))
+            if raw and peak_mb:
+                self.ratios = (self.ratios + [peak_mb / raw])[-self.max_samples:]
+                self._save_calibration()
+        self._dispatch()
+
+    def _dispatch(self):
+        # 严格按顺序：队首放不下时后面的任务也等待，避免大任务饿死
+        to_start = []
+        with self.lock:
+            scale = self.scale()
+            while self.waiting and len(self.running) < self.max_running:
+                task_id, job, raw = self.waiting[0]
+                estimate = raw * scale
+                if self.running and self.used_mb + estimate > self.budget_mb:
+                    break
+                self.waiting.popleft()
+                self.running[task_id] = (raw, estimate)
+                to_start.append((task_id, job))
+        # 在锁外启动：任务可能立即结束并回调 finished()
+        for task_id, job in to_start:
+            self.start_job(task_id, job)
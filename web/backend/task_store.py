@@ -0,0 +1,417 @@
+"""
+任务状态存储
+MemoryTaskStore 只在单个 API 进程内有效；SQLiteTaskStore 保存在 WAL 模式的 SQLite 文件中，
+服务重启后任务仍可查询，同一台机器上的多个 uvicorn 工作进程共享任务状态
+另外记录每个 job_key 已生成的海报文件（输出记录不随任务淘汰，文件删除后由调用方移除）
+已结束的任务保留 ttl 秒后删除；创建超过 max_age 秒仍未结束的任务（所属进程已经不在，
+例如重启后 PID 被其他进程复用）标记为失败，随后同样被删除，存储大小保持有界
+"""
+
+from typing import Any, Dict, List, Optional
+from pathlib import Path
+import abc
+import json
+import os
+import sqlite3
+import threading
+import time
+
+FINISHED_STATUSES = ("completed", "failed")
+
+# 任务记录的字段（SQLite 表的列）
+TASK_FIELDS = (
+    "status", "progress", "stage", "result", "error", "job_key", "attached_to",
+    "estimated_memory_mb", "peak_memory_mb", "created_at", "finished_at", "owner_pid",
+)
+
+STALE_ERROR = "Task was abandoned: it did not finish within the maximum run and queue time"
+
+# 任务结束时复制给挂在它上面的任务的字段
+SHARED_FIELDS = ("status", "progress", "stage", "result", "error", "finished_at")
+
+
+def new_task(**fields) -> Dict[str, Any]:
+    task = dict.fromkeys(TASK_FIELDS)
+    task.update(status="pending", progress=0, created_at=time.time(), owner_pid=os.getpid())
+    task.update(fields)
+    return task
+
+
+def check_fields(fields: Dict[str, Any]):
+    unknown = set(fields) - set(TASK_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown task fields: {', '.join(sorted(unknown))}")
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class TaskStore(abc.ABC):
+    """
+    任务存储接口；记录是包含 TASK_FIELDS 的字典
+    """
+
+    # 两次淘汰之间的最短间隔（秒）
+    evict_interval = 60
+
+    def __init__(self, ttl: float, max_age: float):
+        self.ttl = ttl
+        self.max_age = max_age
+        self.last_evicted = 0.0
+
+    @abc.abstractmethod
+    def create(self, task_id: str, **fields):
+        """
+        创建任务记录，未给出的字段使用 new_task() 的默认值
+        """
+
+    @abc.abstractmethod
+    def get(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """
+        返回任务记录的副本，不存在时返回 None
+        """
+
+    @abc.abstractmethod
+    def update(self, task_id: str, **fields):
+        """
+        更新任务字段；未知字段抛出 ValueError
+        """
+
+    @abc.abstractmethod
+    def delete(self, task_id: str):
+        """
+        删除任务记录
+        """
+
+    @abc.abstractmethod
+    def update_progress(self, task_id: str, progress: int, stage: Optional[str]):
+        """
+        原子地推进进度：进度只增不减（乱序到达的旧阶段被忽略），已结束的任务不受影响
+        """
+
+    @abc.abstractmethod
+    def finish(self, task_id: str, status: str, **fields):
+        """
+        结束任务，并把结果同步给挂在它上面的任务
+        """
+
+    @abc.abstractmethod
+    def attach(self, task_id: str, primary_id: str):
+        """
+        把任务挂到正在运行的相同任务上；如果该任务刚好已经结束，直接复制它的结果
+        """
+
+    @abc.abstractmethod
+    def find_running(self, job_key: str) -> Optional[str]:
+        """
+        查找 job_key 相同、尚未结束且未超过 max_age 的任务（不包括挂在别的任务上的）
+        """
+
+    @abc.abstractmethod
+    def record_output(self, job_key: str, poster_file: str):
+        """
+        记录 job_key 对应的海报文件，覆盖之前的记录
+        """
+
+    @abc.abstractmethod
+    def find_output(self, job_key: str) -> Optional[str]:
+        """
+        返回 job_key 对应的海报文件（所有 API 进程共享），没有记录时返回 None
+        """
+
+    @abc.abstractmethod
+    def forget_output(self, job_key: str):
+        """
+        删除 job_key 的输出记录（海报文件已不存在）
+        """
+
+    @abc.abstractmethod
+    def fail_orphaned(self, error: str) -> int:
+        """
+        启动时把所属进程已经不存在的未结束任务标记为失败，返回数量
+        """
+
+    @abc.abstractmethod
+    def evict_expired(self) -> int:
+        """
+        把超过 max_age 仍未结束的任务标记为失败，删除结束超过 ttl 秒的任务，返回删除数量
+        """
+
+    def maybe_evict(self):
+        now = time.time()
+        if now - self.last_evicted >= self.evict_interval:
+            self.last_evicted = now
+            self.evict_expired()
+
+
+class MemoryTaskStore(TaskStore):
+    """
+    进程内任务存储（只适用于单个 API 进程）
+    """
+
+    def __init__(self, ttl: float, max_age: float):
+        super().__init__(ttl, max_age)
+        self.lock = threading.Lock()
+        self.tasks: Dict[str, Dict[str, Any]] = {}
+        self.outputs: Dict[str, str] = {}
+
+    def create(self, task_id: str, **fields):
+        with self.lock:
+            self.tasks[task_id] = new_task(**fields)
+        self.maybe_evict()
+
+    def get(self, task_id: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            task = self.tasks.get(task_id)
+            return dict(task) if task is not None else None
+
+    def update(self, task_id: str, **fields):
+        check_fields(fields)
+        with self.lock:
+            if task_id in self.tasks:
+                self.tasks[task_id].update(fields)
+
+    def delete(self, task_id: str):
+        with self.lock:
+            self.tasks.pop(task_id, None)
+
+    def update_progress(self, task_id: str, progress: int, stage: Optional[str]):
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None or task["status"] in FINISHED_STATUSES:
+                return
+            task["status"] = "processing"
+            if progress >= task["progress"]:
+                task.update(progress=progress, stage=stage)
+
+    def finish(self, task_id: str, status: str, **fields):
+        fields.update(status=status, finished_at=time.time())
+        check_fields(fields)
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None:
+                return
+            task.update(fields)
+            shared = {field: task[field] for field in SHARED_FIELDS}
+            for other in self.tasks.values():
+                if other["attached_to"] == task_id:
+                    other.update(shared)
+
+    def attach(self, task_id: str, primary_id: str):
+        with self.lock:
+            primary = self.tasks.get(primary_id)
+            task = self.tasks.get(task_id)
+            if task is None:
+                return
+            task["attached_to"] = primary_id
+            if primary is not None and primary["status"] in FINISHED_STATUSES:
+                task.update({field: primary[field] for field in SHARED_FIELDS})
+
+    def find_running(self, job_key: str) -> Optional[str]:
+        cutoff = time.time() - self.max_age
+        with self.lock:
+            for task_id, task in self.tasks.items():
+                if (task["job_key"] == job_key and task["attached_to"] is None
+                        and task["status"] not in FINISHED_STATUSES and task["created_at"] >= cutoff):
+                    return task_id
+        return None
+
+    def record_output(self, job_key: str, poster_file: str):
+        with self.lock:
+            self.outputs[job_key] = poster_file
+
+    def find_output(self, job_key: str) -> Optional[str]:
+        with self.lock:
+            return self.outputs.get(job_key)
+
+    def forget_output(self, job_key: str):
+        with self.lock:
+            self.outputs.pop(job_key, None)
+
+    def fail_orphaned(self, error: str) -> int:
+        # 进程内存储随进程一起消失，不会有孤儿任务
+        return 0
+
+    def evict_expired(self) -> int:
+        with self.lock:
+            stale = [
+                task_id for task_id, task in self.tasks.items()
+                if task["status"] not in FINISHED_STATUSES and task["attached_to"] is None
+                and task["created_at"] < time.time() - self.max_age
+            ]
+        for task_id in stale:
+            self.finish(task_id, "failed", error=STALE_ERROR)
+        cutoff = time.time() - self.ttl
+        with self.lock:
+            expired = [
+                task_id for task_id, task in self.tasks.items()
+                if task["finished_at"] is not None and task["finished_at"] < cutoff
+            ]
+            for task_id in expired:
+                del self.tasks[task_id]
+        return len(expired)
+
+
+class SQLiteTaskStore(TaskStore):
+    """
+    SQLite 任务存储：WAL 模式允许多个进程同时读写，每个线程使用自己的连接
+    """
+
+    def __init__(self, path: Path, ttl: float, max_age: float):
+        super().__init__(ttl, max_age)
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.local = threading.local()
+        with self.connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                "task_id TEXT PRIMARY KEY, status TEXT NOT NULL, progress INTEGER NOT NULL, "
+                "stage TEXT, result TEXT, error TEXT, job_key TEXT, attached_to TEXT, "
+                "estimated_memory_mb REAL, peak_memory_mb REAL, created_at REAL NOT NULL, "
+                "finished_at REAL, owner_pid INTEGER)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_job_key ON tasks (job_key)")
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_finished_at ON tasks (finished_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_attached_to ON tasks (attached_to)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS outputs ("
+                "job_key TEXT PRIMARY KEY, poster_file TEXT NOT NULL, recorded_at REAL NOT NULL)"
+            )
+
+    def connect(self) -> sqlite3.Connection:
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.path), timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    @staticmethod
+    def encode(fields: Dict[str, Any]) -> Dict[str, Any]:
+        check_fields(fields)
+        if fields.get("result") is not None:
+            fields = dict(fields, result=json.dumps(fields["result"]))
+        return fields
+
+    @staticmethod
+    def decode(row: sqlite3.Row) -> Dict[str, Any]:
+        task = {field: row[field] for field in TASK_FIELDS}
+        if task["result"] is not None:
+            task["result"] = json.loads(task["result"])
+        return task
+
+    def create(self, task_id: str, **fields):
+        task = self.encode(new_task(**fields))
+        columns = ", ".join(("task_id",) + TASK_FIELDS)
+        placeholders = ", ".join("?" * (len(TASK_FIELDS) + 1))
+        with self.connect() as conn:
+            conn.execute(
+                f"INSERT INTO tasks ({columns}) VALUES ({placeholders})",
+                [task_id] + [task[field] for field in TASK_FIELDS]
+            )
+        self.maybe_evict()
+
+    def get(self, task_id: str) -> Optional[Dict[str, Any]]:
+        row = self.connect().execute("SELECT * FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return self.decode(row) if row is not None else None
+
+    def update(self, task_id: str, **fields):
+        fields = self.encode(fields)
+        assignments = ", ".join(f"{field} = ?" for field in fields)
+        with self.connect() as conn:
+            conn.execute(f"UPDATE tasks SET {assignments} WHERE task_id = ?", list(fields.values()) + [task_id])
+
+    def delete(self, task_id: str):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM tasks WHERE task_id = ?", (task_id,))
+
+    def update_progress(self, task_id: str, progress: int, stage: Optional[str]):
+        with self.connect() as conn:
+            conn.execute(
+                "UPDATE tasks SET status = 'processing', progress = MAX(progress, ?), "
+                "stage = CASE WHEN ? >= progress THEN ? ELSE stage END "
+                "WHERE task_id = ? AND status NOT IN (?, ?)",
+                (progress, progress, stage, task_id) + FINISHED_STATUSES
+            )
+
+    def finish(self, task_id: str, status: str, **fields):
+        fields = self.encode(dict(fields, status=status, finished_at=time.time()))
+        assignments = ", ".join(f"{field} = ?" for field in fields)
+        shared = ", ".join(f"{field} = (SELECT {field} FROM tasks WHERE task_id = ?)" for field in SHARED_FIELDS)
+        with self.connect() as conn:
+            conn.execute(f"UPDATE tasks SET {assignments} WHERE task_id = ?", list(fields.values()) + [task_id])
+            conn.execute(
+                f"UPDATE tasks SET {shared} WHERE attached_to = ?",
+                [task_id] * len(SHARED_FIELDS) + [task_id]
+            )
+
+    def attach(self, task_id: str, primary_id: str):
+        shared = ", ".join(f"{field} = (SELECT {field} FROM tasks WHERE task_id = ?)" for field in SHARED_FIELDS)
+        with self.connect() as conn:
+            conn.execute("UPDATE tasks SET attached_to = ? WHERE task_id = ?", (primary_id, task_id))
+            conn.execute(
+                f"UPDATE tasks SET {shared} WHERE task_id = ? "
+                f"AND (SELECT status FROM tasks WHERE task_id = ?) IN (?, ?)",
+                [primary_id] * len(SHARED_FIELDS) + [task_id, primary_id] + list(FINISHED_STATUSES)
+            )
+
+    def find_running(self, job_key: str) -> Optional[str]:
+        row = self.connect().execute(
+            "SELECT task_id FROM tasks WHERE job_key = ? AND attached_to IS NULL AND status NOT IN (?, ?) "
+            "AND created_at >= ? ORDER BY created_at LIMIT 1",
+            (job_key,) + FINISHED_STATUSES + (time.time() - self.max_age,)
+        ).fetchone()
+        return row["task_id"] if row is not None else None
+
+    def record_output(self, job_key: str, poster_file: str):
+        with self.connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO outputs (job_key, poster_file, recorded_at) VALUES (?, ?, ?)",
+                (job_key, poster_file, time.time())
+            )
+
+    def find_output(self, job_key: str) -> Optional[str]:
+        row = self.connect().execute("SELECT poster_file FROM outputs WHERE job_key = ?", (job_key,)).fetchone()
+        return row["poster_file"] if row is not None else None
+
+    def forget_output(self, job_key: str):
+        with self.connect() as conn:
+            conn.execute("DELETE FROM outputs WHERE job_key = ?", (job_key,))
+
+    def fail_orphaned(self, error: str) -> int:
+        conn = self.connect()
+        rows = conn.execute(
+            "SELECT task_id, owner_pid FROM tasks WHERE status NOT IN (?, ?) AND attached_to IS NULL",
+            FINISHED_STATUSES
+        ).fetchall()
+        # 当前进程刚启动，不会有属于自己的任务：相同的 PID 说明是重启前的进程
+        orphaned: List[str] = [
+            row["task_id"] for row in rows
+            if row["owner_pid"] is None or row["owner_pid"] == os.getpid() or not pid_alive(row["owner_pid"])
+        ]
+        for task_id in orphaned:
+            self.finish(task_id, "failed", error=error)
+        return len(orphaned)
+
+    def evict_expired(self) -> int:
+        stale = self.connect().execute(
+            "SELECT task_id FROM tasks WHERE status NOT IN (?, ?) AND attached_to IS NULL AND created_at < ?",
+            FINISHED_STATUSES + (time.time() - self.max_age,)
+        ).fetchall()
+        for row in stale:
+            self.finish(row["task_id"], "failed", error=STALE_ERROR)
+        with self.connect() as conn:
+            cursor = conn.execute(
+                "DELETE FROM tasks WHERE finished_at IS NOT NULL AND finished_at < ?",
+                (time.time() - self.ttl,)
+            )
+        return cursor.rowcount
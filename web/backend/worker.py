@@ -0,0 +1,178 @@
+"""
+地图海报生成任务的工作进程部分
+在后端的进程池中运行，通过进度事件队列把阶段进度发回 API 进程
+"""
+
+from typing import Any, Dict, Optional, Tuple
+from datetime import datetime
+from pathlib import Path
+import json
+
+from create_map_poster import (
+    create_poster,
+    load_map_data,
+)
+
+# create_map_poster 各阶段对应的任务进度（0-100）；geocode 由 API 进程在提交任务前报告
+STAGE_PROGRESS = {
+    "geocode": 10,
+    "network": 30,
+    "water": 45,
+    "parks": 55,
+    "draw": 65,
+    "save": 80,
+    "thumbnail": 90,
+}
+
+# 进度事件队列（由进程池 initializer 设置）
+_events = None
+
+
+def init_worker(events):
+    """
+    进程池初始化：保存进度事件队列
+    """
+    global _events
+    _events = events
+
+
+def report_progress(task_id: str, stage: str):
+    """
+    发送一个进度事件：(task_id, progress, stage)
+    """
+    if _events is not None:
+        _events.put((task_id, STAGE_PROGRESS.get(stage, 0), stage))
+
+
+def reset_peak_memory():
+    """
+    重置本进程的峰值内存（VmHWM），工作进程会被多个任务复用
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_memory_mb() -> Optional[float]:
+    """
+    本进程自上次重置以来的峰值内存（MB），非 Linux 平台返回 None
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def generate_map_poster(task_id: str, job: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[float]]:
+    """
+    工作进程任务：生成地图海报，返回 (任务结果, 峰值内存 MB)
+    job 包含 GenerateRequest 的字段以及 API 进程解析好的坐标、size_tuple、size_label、temp_posters_dir、job_key
+    """
+    reset_peak_memory()
+    city = job["city"]
+    country = job["country"]
+    theme = job["theme"]
+    distance = job["distance"]
+    network_type = job["network_type"]
+    use_svg = job["use_svg"]
+    thumbnail = job["thumbnail"]
+
+    def progress_callback(stage):
+        report_progress(task_id, stage)
+
+    try:
+        # 1. 坐标（API 进程已解析）
+        coords = (job["latitude"], job["longitude"])
+        print(f"Using coordinates: {coords[0]}, {coords[1]}")
+
+        # 2. 准备输出目录（保存到临时文件夹）
+        run_id = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+        # 同一个城市使用同一个文件夹，不带时间戳
+        city_slug = city.lower().replace(' ', '_')
+        temp_run_dir = Path(job["temp_posters_dir"]) / city_slug
+        temp_run_dir.mkdir(parents=True, exist_ok=True)
+
+        temp_thumbnails_dir = temp_run_dir / "thumbnails"
+        temp_thumbnails_dir.mkdir(exist_ok=True)
+
+        temp_collages_dir = temp_thumbnails_dir / "collages"
+        temp_collages_dir.mkdir(exist_ok=True)
+
+        # 3. 生成海报
+        output_file = temp_run_dir / f"{theme}_{run_id}.{'svg' if use_svg else 'png'}"
+
+        # 下载地图数据（可在多个主题间复用）
+        dataset = load_map_data(coords, distance, network_type, progress_callback=progress_callback)
+
+        thumbnail_collector = [] if thumbnail else None
+        create_poster(
+            city=city,
+            country=country,
+            point=coords,
+            dist=distance,
+            output_file=str(output_file),
+            network_type=network_type,
+            make_thumbnail=thumbnail,
+            thumbnails_dir=str(temp_thumbnails_dir) if thumbnail else None,
+            thumbnail_collector=thumbnail_collector,
+            show_attribution=not job["hide_attribution"],
+            use_svg=use_svg,
+            theme_name=theme,
+            poster_size=job["size_tuple"],
+            dataset=dataset,
+            progress_callback=progress_callback
+        )
+        del dataset
+
+        # 保存元数据到 JSON 文件
+        metadata = {
+            "poster_size": job["poster_size"],
+            "size_label": job["size_label"],
+            "city": city,
+            "country": country,
+            "latitude": coords[0],
+            "longitude": coords[1],
+            "theme": theme,
+            "distance": distance,
+            "network_type": network_type,
+            "format": "svg" if use_svg else "png",
+            "created_at": run_id,
+            "job_key": job["job_key"]
+        }
+        metadata_file = temp_run_dir / f"{theme}_{run_id}.json"
+        with open(metadata_file, 'w') as f:
+            json.dump(metadata, f, indent=2)
+
+        # 4. 构建结果（指向临时文件夹）
+        poster_url = f"/temp_posters/{temp_run_dir.name}/{output_file.name}"
+        thumb_url = None
+        if thumbnail and thumbnail_collector:
+            thumb_url = f"/temp_posters/{temp_run_dir.name}/thumbnails/{Path(thumbnail_collector[0]).name}"
+
+        print(f"✓ Task {task_id} completed successfully")
+        result = {
+            "poster_url": poster_url,
+            "thumbnail_url": thumb_url,
+            "city": city,
+            "country": country,
+            "theme": theme,
+            "coords": coords,
+            "created_at": run_id,
+            "poster_size": job["poster_size"],
+            "size_label": job["size_label"]
+        }
+        return result, peak_memory_mb()
+
+    except Exception as e:
+        print(f"✗ Task {task_id} failed: {e}")
+        import traceback
+        traceback.print_exc()
+        # 只把错误信息传回 API 进程（并非所有异常都能被 pickle）
+        raise RuntimeError(str(e)) from None
@@ -46,6 +46,7 @@ export interface TaskStatusResponse {
   task_id: string;
   status: string;
   progress: number;
+  stage?: string | null;
   result?: {
     poster_url: string;
     thumbnail_url: string | null;